@@ -1,7 +1,272 @@
-from flask import jsonify, request
-from sqlalchemy import text, and_, or_
+from flask import Response, g, jsonify, request, stream_with_context
+from sqlalchemy import bindparam, text, and_, or_
 from datetime import datetime, timedelta
+import functools
 import logging
+import threading
+from cachetools import TTLCache
+import numpy as np
+import orjson
+import pandas as pd
+
+# Sales window baked into mv_recent_sales_velocity (see schema.sql)
+DEFAULT_RECENT_SALES_DAYS = 90
+
+# Rows fetched per round-trip when streaming alerts
+ALERTS_BATCH_SIZE = 500
+
+# Short-lived cache of rendered alert responses for polling dashboards,
+# keyed by (company_id, warehouse_ids, category_ids, recent_sales_days).
+# Stock levels and thresholds are read live on every miss, so
+# invalidate_low_stock_alerts_cache makes writes visible on the next poll for
+# both windows. Default-window sales velocity is only as fresh as the last
+# mv_recent_sales_velocity refresh (run out of process), plus at most the TTL.
+ALERTS_CACHE_TTL_SECONDS = 30
+ALERTS_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Per-worker budget for cached bodies
+ALERTS_CACHE_MAX_ALERTS = 1000  # Larger responses are streamed but not cached
+_alerts_cache = TTLCache(maxsize=ALERTS_CACHE_MAX_BYTES, ttl=ALERTS_CACHE_TTL_SECONDS, getsizeof=len)
+_alerts_cache_lock = threading.Lock()
+# Bumped on invalidation so responses rendered from older data aren't stored
+_alerts_cache_generations = {}
+
+# Sales velocity per product/warehouse, computed live for custom windows
+LIVE_SALES_VELOCITY_CTE = """
+daily_sales AS (
+    -- One row per product/warehouse/day, so active days are a plain COUNT(*)
+    -- (hash aggregate) rather than a sorting COUNT(DISTINCT ...)
+    SELECT 
+        si.product_id,
+        si.warehouse_id,
+        s.sale_day,
+        SUM(si.quantity) as quantity
+    FROM sale_items si
+    JOIN sales s ON si.sale_id = s.id
+    WHERE s.company_id = :company_id 
+        AND s.sale_date >= :recent_cutoff
+        AND s.status = 'completed'
+    GROUP BY si.product_id, si.warehouse_id, s.sale_day
+),
+recent_sales_velocity AS (
+    SELECT 
+        product_id,
+        warehouse_id,
+        SUM(quantity) as total_sold,
+        COUNT(*) as sales_days
+    FROM daily_sales
+    GROUP BY product_id, warehouse_id
+)
+"""
+
+# The default window reads the precomputed aggregate (see schema.sql)
+MV_SALES_VELOCITY_CTE = """
+recent_sales_velocity AS (
+    SELECT product_id, warehouse_id, total_sold, sales_days
+    FROM mv_recent_sales_velocity
+    WHERE company_id = :company_id
+)
+"""
+
+# Alerts query; inventory, thresholds and warehouses are always read live
+ALERTS_QUERY = """
+WITH {sales_velocity}
+SELECT 
+    p.id as product_id,
+    p.name as product_name,
+    p.sku,
+    w.id as warehouse_id,
+    w.name as warehouse_name,
+    i.quantity as current_stock,
+    p.low_stock_threshold as threshold,
+    rsv.total_sold::float / NULLIF(:recent_days, 0) as daily_velocity,
+    rsv.total_sold,
+    rsv.sales_days,
+    -- days_until_stockout is derived client-side (see _build_alerts)
+    -- Summary counts over the whole result, repeated on every row
+    COUNT(*) FILTER (
+        WHERE CASE 
+            WHEN rsv.total_sold > 0 AND :recent_days > 0 THEN 
+                FLOOR(i.quantity / (rsv.total_sold::float / :recent_days) + 0.5)
+            ELSE 
+                999
+        END <= 7
+    ) OVER () as critical_count,
+    COUNT(*) OVER () as total_count
+    -- Supplier info is fetched separately for the returned products (_SUPPLIERS_STMT)
+FROM products p
+JOIN inventory i ON p.id = i.product_id
+JOIN warehouses w ON i.warehouse_id = w.id
+JOIN recent_sales_velocity rsv ON p.id = rsv.product_id AND i.warehouse_id = rsv.warehouse_id
+WHERE 
+    p.company_id = :company_id
+    AND w.company_id = :company_id
+    AND p.is_active = true
+    AND w.is_active = true
+    AND i.quantity <= p.low_stock_threshold
+    AND rsv.total_sold > 0  -- Only products with recent sales
+    -- Optional warehouse/category filters
+    {filters}
+ORDER BY 
+    (i.quantity::float / NULLIF(p.low_stock_threshold, 0)) ASC,  -- Most critical first
+    daily_velocity DESC  -- Then by sales velocity
+"""
+
+# Sales velocity CTEs by source
+_SALES_VELOCITY_SOURCES = {
+    'live': LIVE_SALES_VELOCITY_CTE,
+    'mv': MV_SALES_VELOCITY_CTE,
+}
+
+# Compiled once at import so SQLAlchemy's statement cache is reused per request
+_SUPPLIERS_STMT = text("""
+    SELECT 
+        sp.product_id,
+        s.id as supplier_id,
+        s.name as supplier_name,
+        s.contact_email as supplier_email,
+        sp.supplier_sku,
+        sp.supplier_price,
+        sp.lead_time_days
+    FROM supplier_products sp
+    JOIN suppliers s ON s.id = sp.supplier_id
+    WHERE sp.product_id IN :product_ids
+        AND sp.is_primary_supplier = true
+""").bindparams(bindparam('product_ids', expanding=True))
+# Bounds how long a slow client can hold the streaming transaction and cursor open
+_STREAM_TIMEOUTS_STMT = text("""
+    SET LOCAL statement_timeout = '30s';
+    SET LOCAL idle_in_transaction_session_timeout = '60s'
+""")
+_VELOCITY_STMT = text("""
+    SELECT 
+        COALESCE(SUM(si.quantity), 0) as total_sold,
+        COUNT(DISTINCT s.sale_day) as sales_days
+    FROM sale_items si
+    JOIN sales s ON si.sale_id = s.id
+    WHERE si.product_id = :product_id 
+        AND si.warehouse_id = :warehouse_id
+        AND s.sale_date >= :cutoff_date
+        AND s.status = 'completed'
+""")
+
+
+# One compiled statement per (source, filters) combination, reused across requests
+@functools.lru_cache(maxsize=None)
+def _alerts_stmt(source, filter_warehouses, filter_categories):
+    """Build the alerts statement with only the filters that are in use"""
+    
+    # Plain IN lists let the planner use the warehouse/category indexes
+    where_clauses = []
+    expanding_params = []
+    if filter_warehouses:
+        where_clauses.append("AND w.id IN :warehouse_ids")
+        expanding_params.append(bindparam('warehouse_ids', expanding=True))
+    if filter_categories:
+        where_clauses.append("AND p.category_id IN :category_ids")
+        expanding_params.append(bindparam('category_ids', expanding=True))
+    
+    query = ALERTS_QUERY.format(
+        sales_velocity=_SALES_VELOCITY_SOURCES[source].strip(),
+        filters="\n    ".join(where_clauses)
+    )
+    
+    # stream_results keeps the rows in a server-side cursor until fetched
+    return (
+        text(query)
+        .bindparams(*expanding_params)
+        .execution_options(stream_results=True)
+    )
+
+
+def invalidate_low_stock_alerts_cache(company_id):
+    """Drop cached alert responses for a company after its stock or thresholds change"""
+    
+    with _alerts_cache_lock:
+        _alerts_cache_generations[company_id] = _alerts_cache_generations.get(company_id, 0) + 1
+        for key in [key for key in _alerts_cache if key[0] == company_id]:
+            _alerts_cache.pop(key, None)
+
+
+def _store_alerts_response(cache_key, cache_generation, body):
+    """Cache a rendered alerts body unless the company was invalidated since it was read"""
+    
+    with _alerts_cache_lock:
+        if _alerts_cache_generations.get(cache_key[0], 0) == cache_generation:
+            _alerts_cache[cache_key] = body
+
+
+def _attach_suppliers(df, connection):
+    """Left-join primary supplier columns onto a batch of alerts"""
+    
+    # One lookup per batch for just the alerted products, instead of joining
+    # suppliers against every inventory row in the main query
+    suppliers = pd.read_sql(_SUPPLIERS_STMT, connection, params={
+        'product_ids': df['product_id'].unique().tolist()
+    })
+    return df.merge(suppliers, on='product_id', how='left')
+
+
+def _render_alerts(df, connection):
+    """Serialize a batch of alerts as comma-separated JSON objects (no [ ])"""
+    
+    alerts = _build_alerts(_attach_suppliers(df, connection))
+    return orjson.dumps(alerts, option=orjson.OPT_SERIALIZE_NUMPY)[1:-1]
+
+
+def _nullable(column, dtype):
+    """Cast a column to dtype, keeping SQL NULLs as None for JSON"""
+    return column.astype(dtype).astype(object).where(column.notna(), None)
+
+
+def _build_alerts(df):
+    """Build the nested alert dicts from an alerts query DataFrame"""
+    
+    # Vectorized casts/clamps instead of per-row float()/min() calls
+    df['daily_velocity'] = pd.to_numeric(df['daily_velocity']).fillna(0).astype(np.float64)
+    
+    # Days until stockout: stock / velocity rounded half up, using the same float
+    # FLOOR(x + 0.5) as the critical_count filter in ALERTS_QUERY,
+    # capped at 999 which also stands in for "no recent sales"
+    quantity = df['current_stock'].to_numpy(dtype=np.float64)
+    velocity = df['daily_velocity'].to_numpy()
+    has_velocity = velocity > 0
+    days_until_stockout = np.floor(quantity / np.where(has_velocity, velocity, 1) + 0.5)
+    df['days_until_stockout'] = np.where(has_velocity, np.minimum(days_until_stockout, 999), 999).astype(np.int64)
+    df['total_sold'] = df['total_sold'].fillna(0).astype(np.int64)
+    df['sales_days'] = df['sales_days'].fillna(0).astype(np.int64)
+    
+    # Supplier columns come from a LEFT JOIN and may be NULL
+    has_supplier = df['supplier_id'].notna().to_numpy()
+    df['supplier_id'] = _nullable(df['supplier_id'], 'Int64')
+    df['supplier_price'] = _nullable(pd.to_numeric(df['supplier_price']), np.float64)
+    df['lead_time_days'] = _nullable(df['lead_time_days'], 'Int64')
+    
+    return [
+        {
+            "product_id": row['product_id'],
+            "product_name": row['product_name'],
+            "sku": row['sku'],
+            "warehouse_id": row['warehouse_id'],
+            "warehouse_name": row['warehouse_name'],
+            "current_stock": row['current_stock'],
+            "threshold": row['threshold'],
+            "days_until_stockout": row['days_until_stockout'],
+            "sales_velocity": {
+                "daily_average": row['daily_velocity'],
+                "total_recent_sales": row['total_sold'],
+                "active_sales_days": row['sales_days']
+            },
+            "supplier": {
+                "id": row['supplier_id'],
+                "name": row['supplier_name'],
+                "contact_email": row['supplier_email'],
+                "supplier_sku": row['supplier_sku'],
+                "supplier_price": row['supplier_price'],
+                "lead_time_days": row['lead_time_days']
+            } if supplier else None
+        }
+        for row, supplier in zip(df.to_dict(orient='records'), has_supplier)
+    ]
+
 
 @app.route('/api/companies/<int:company_id>/alerts/low-stock', methods=['GET'])
 def get_low_stock_alerts(company_id):
@@ -13,6 +278,10 @@ def get_low_stock_alerts(company_id):
     - Only alert for products with recent sales activity (last 90 days)
     - Include supplier information for reordering
     - Calculate days until stockout based on recent sales velocity
+    
+    Responses with more than ALERTS_BATCH_SIZE alerts are streamed. If a
+    later batch fails, the 200 response ends with a truncated (invalid)
+    JSON body, so clients should treat a body that doesn't parse as a failure.
     """
     
     try:
@@ -29,132 +298,51 @@ def get_low_stock_alerts(company_id):
         category_ids = request.args.getlist('category_ids', type=int)
         
         # Define recent sales period (configurable)
-        recent_sales_days = request.args.get('recent_sales_days', 90, type=int)
-        recent_sales_cutoff = datetime.utcnow() - timedelta(days=recent_sales_days)
-        
-        # Build the complex query using SQLAlchemy
-        alerts_query = """
-        WITH recent_sales_velocity AS (
-            SELECT 
-                si.product_id,
-                si.warehouse_id,
-                COALESCE(SUM(si.quantity), 0) as total_sold,
-                COALESCE(SUM(si.quantity) / NULLIF(:recent_days, 0), 0) as daily_velocity,
-                COUNT(DISTINCT s.sale_date::date) as sales_days
-            FROM sale_items si
-            JOIN sales s ON si.sale_id = s.id
-            WHERE s.company_id = :company_id 
-                AND s.sale_date >= :recent_cutoff
-                AND s.status = 'completed'
-            GROUP BY si.product_id, si.warehouse_id
-        ),
-        product_thresholds AS (
-            SELECT 
-                p.id as product_id,
-                COALESCE(pc.low_stock_threshold, 10) as threshold
-            FROM products p
-            LEFT JOIN product_categories pc ON p.category_id = pc.id
-            WHERE p.company_id = :company_id
-        )
-        SELECT DISTINCT
-            p.id as product_id,
-            p.name as product_name,
-            p.sku,
-            w.id as warehouse_id,
-            w.name as warehouse_name,
-            i.quantity as current_stock,
-            pt.threshold,
-            rsv.daily_velocity,
-            rsv.total_sold,
-            rsv.sales_days,
-            -- Calculate days until stockout (0 if no sales velocity)
-            CASE 
-                WHEN rsv.daily_velocity > 0 THEN 
-                    ROUND(i.quantity / rsv.daily_velocity)
-                ELSE 
-                    999 -- High number if no recent sales
-            END as days_until_stockout,
-            -- Get primary supplier info
-            s.id as supplier_id,
-            s.name as supplier_name,
-            s.contact_email as supplier_email,
-            sp.supplier_sku,
-            sp.supplier_price,
-            sp.lead_time_days
-        FROM products p
-        JOIN inventory i ON p.id = i.product_id
-        JOIN warehouses w ON i.warehouse_id = w.id
-        JOIN product_thresholds pt ON p.id = pt.product_id
-        LEFT JOIN recent_sales_velocity rsv ON p.id = rsv.product_id AND i.warehouse_id = rsv.warehouse_id
-        LEFT JOIN supplier_products sp ON p.id = sp.product_id AND sp.is_primary_supplier = true
-        LEFT JOIN suppliers s ON sp.supplier_id = s.id
-        WHERE 
-            p.company_id = :company_id
-            AND w.company_id = :company_id
-            AND p.is_active = true
-            AND w.is_active = true
-            AND i.quantity <= pt.threshold
-            AND rsv.total_sold > 0  -- Only products with recent sales
-            -- Optional warehouse filtering
-            AND (:warehouse_filter = false OR w.id = ANY(:warehouse_ids))
-            -- Optional category filtering  
-            AND (:category_filter = false OR p.category_id = ANY(:category_ids))
-        ORDER BY 
-            (i.quantity::float / NULLIF(pt.threshold, 0)) ASC,  -- Most critical first
-            rsv.daily_velocity DESC  -- Then by sales velocity
-        """
-        
-        # Execute query with parameters
-        result = db.session.execute(text(alerts_query), {
-            'company_id': company_id,
-            'recent_days': recent_sales_days,
-            'recent_cutoff': recent_sales_cutoff,
-            'warehouse_filter': len(warehouse_ids) > 0,
-            'warehouse_ids': warehouse_ids or [0],
-            'category_filter': len(category_ids) > 0,
-            'category_ids': category_ids or [0]
-        })
-        
-        # Process results
-        alerts = []
-        for row in result:
-            alert = {
-                "product_id": row.product_id,
-                "product_name": row.product_name,
-                "sku": row.sku,
-                "warehouse_id": row.warehouse_id,
-                "warehouse_name": row.warehouse_name,
-                "current_stock": row.current_stock,
-                "threshold": row.threshold,
-                "days_until_stockout": min(row.days_until_stockout, 999),  # Cap at 999
-                "sales_velocity": {
-                    "daily_average": float(row.daily_velocity or 0),
-                    "total_recent_sales": row.total_sold or 0,
-                    "active_sales_days": row.sales_days or 0
-                }
-            }
-            
-            # Add supplier information if available
-            if row.supplier_id:
-                alert["supplier"] = {
-                    "id": row.supplier_id,
-                    "name": row.supplier_name,
-                    "contact_email": row.supplier_email,
-                    "supplier_sku": row.supplier_sku,
-                    "supplier_price": float(row.supplier_price) if row.supplier_price else None,
-                    "lead_time_days": row.lead_time_days
-                }
-            else:
-                alert["supplier"] = None
-                
-            alerts.append(alert)
-        
-        # Calculate summary statistics
-        total_alerts = len(alerts)
-        critical_alerts = len([a for a in alerts if a["days_until_stockout"] <= 7])
-        
-        response = {
-            "alerts": alerts,
+        recent_sales_days = request.args.get('recent_sales_days', DEFAULT_RECENT_SALES_DAYS, type=int)
+        
+        # Serve repeated polls for the same filters from the response cache
+        cache_key = (company_id, tuple(sorted(warehouse_ids)), tuple(sorted(category_ids)), recent_sales_days)
+        with _alerts_cache_lock:
+            cached = _alerts_cache.get(cache_key)
+            cache_generation = _alerts_cache_generations.get(company_id, 0)
+        if cached is not None:
+            return Response(cached, mimetype='application/json'), 200
+        
+        # Only bind what the chosen statement uses; the SQL itself is prebuilt at module scope
+        params = {'company_id': company_id, 'recent_days': recent_sales_days}
+        
+        # Default-window sales velocity is precomputed; custom windows aggregate live
+        if recent_sales_days == DEFAULT_RECENT_SALES_DAYS:
+            source = 'mv'
+        else:
+            source = 'live'
+            params['recent_cutoff'] = datetime.utcnow() - timedelta(days=recent_sales_days)
+        
+        alerts_stmt = _alerts_stmt(source, bool(warehouse_ids), bool(category_ids))
+        
+        if warehouse_ids:
+            params['warehouse_ids'] = warehouse_ids
+        if category_ids:
+            params['category_ids'] = category_ids
+        
+        # Fetch DataFrame batches from a server-side cursor so memory stays O(batch)
+        connection = db.session.connection()
+        chunks = pd.read_sql(alerts_stmt, connection, params=params,
+                             chunksize=ALERTS_BATCH_SIZE)
+        
+        # Fetch and fully render the first batch (suppliers, post-processing,
+        # JSON) before any headers go out, so failures there still produce a 500
+        first_chunk = next(chunks, pd.DataFrame())
+        first_batch = _render_alerts(first_chunk, connection) if len(first_chunk) else b''
+        
+        # Summary statistics are computed by the query itself
+        if len(first_chunk):
+            total_alerts = int(first_chunk['total_count'].iat[0])
+            critical_alerts = int(first_chunk['critical_count'].iat[0])
+        else:
+            total_alerts = critical_alerts = 0
+        
+        response_tail = {
             "total_alerts": total_alerts,
             "critical_alerts": critical_alerts,
             "summary": {
@@ -168,7 +356,45 @@ def get_low_stock_alerts(company_id):
         if total_alerts > 0:
             app.logger.info(f"Low stock alerts generated: {total_alerts} total, {critical_alerts} critical for company {company_id}")
         
-        return jsonify(response), 200
+        cacheable = total_alerts <= ALERTS_CACHE_MAX_ALERTS
+        
+        # Everything fit in the first batch: send the complete body and release
+        # the cursor now rather than holding the transaction open while streaming
+        if total_alerts <= len(first_chunk):
+            chunks.close()
+            body = b'{"alerts":[' + first_batch + b'],' + orjson.dumps(response_tail)[1:]
+            if cacheable:
+                _store_alerts_response(cache_key, cache_generation, body)
+            return Response(body, mimetype='application/json'), 200
+        
+        connection.execute(_STREAM_TIMEOUTS_STMT)
+        
+        def generate():
+            # Same shape as before: {"alerts": [...], "total_alerts": ..., ...}
+            parts = []
+            
+            def emit(part):
+                if cacheable:
+                    parts.append(part)
+                return part
+            
+            yield emit(b'{"alerts":[' + first_batch)
+            separator = b',' if first_batch else b''
+            try:
+                for chunk in chunks:
+                    if len(chunk):
+                        yield emit(separator + _render_alerts(chunk, connection))
+                        separator = b','
+            except Exception as e:
+                # Headers are already sent; all we can do is log and end the stream
+                app.logger.error(f"Error streaming low stock alerts for company {company_id}: {str(e)}")
+                raise
+            yield emit(b'],' + orjson.dumps(response_tail)[1:])
+            
+            if cacheable:
+                _store_alerts_response(cache_key, cache_generation, b''.join(parts))
+        
+        return Response(stream_with_context(generate()), mimetype='application/json'), 200
         
     except Exception as e:
         app.logger.error(f"Error generating low stock alerts for company {company_id}: {str(e)}")
@@ -200,7 +426,10 @@ def update_product_threshold(company_id, product_id):
         if product.category_id:
             category = ProductCategory.query.get(product.category_id)
             category.low_stock_threshold = new_threshold
+            # A trigger copies the threshold to products.low_stock_threshold
+            # in the same transaction, so both tables commit together
             db.session.commit()
+            invalidate_low_stock_alerts_cache(company_id)
             
             return jsonify({
                 "message": "Threshold updated successfully",
@@ -216,23 +445,43 @@ def update_product_threshold(company_id, product_id):
         return jsonify({"error": "Failed to update threshold"}), 500
 
 
+def refresh_sales_velocity():
+    """Refresh the precomputed default-window sales velocity without blocking readers"""
+    
+    db.session.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_recent_sales_velocity"))
+    db.session.commit()
+
+
+# Must be scheduled (see schema.sql), e.g. */5 * * * * flask refresh-sales-velocity
+@app.cli.command('refresh-sales-velocity')
+def refresh_sales_velocity_command():
+    """Refresh mv_recent_sales_velocity"""
+    
+    refresh_sales_velocity()
+    app.logger.info("Refreshed mv_recent_sales_velocity")
+
+
 # Utility function for testing/debugging
 def calculate_stock_velocity(product_id, warehouse_id, days=90):
     """Calculate sales velocity for a product in a warehouse"""
     
-    cutoff_date = datetime.utcnow() - timedelta(days=days)
-    
-    result = db.session.execute(text("""
-        SELECT 
-            COALESCE(SUM(si.quantity), 0) as total_sold,
-            COUNT(DISTINCT s.sale_date::date) as sales_days
-        FROM sale_items si
-        JOIN sales s ON si.sale_id = s.id
-        WHERE si.product_id = :product_id 
-            AND si.warehouse_id = :warehouse_id
-            AND s.sale_date >= :cutoff_date
-            AND s.status = 'completed'
-    """), {
+    # Memoize per request first, then fall back to the process-wide cache
+    if 'velocity_cache' not in g:
+        g.velocity_cache = {}
+    
+    key = (product_id, warehouse_id, days)
+    if key not in g.velocity_cache:
+        # Bucket the cutoff to the hour so cached results roll over hourly
+        cutoff_date = (datetime.utcnow() - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+        g.velocity_cache[key] = _cached_stock_velocity(product_id, warehouse_id, days, cutoff_date)
+    
+    # Copy so callers can't mutate the cached result
+    return dict(g.velocity_cache[key])
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_stock_velocity(product_id, warehouse_id, days, cutoff_date):
+    result = db.session.execute(_VELOCITY_STMT, {
         'product_id': product_id,
         'warehouse_id': warehouse_id,
         'cutoff_date': cutoff_date
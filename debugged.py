@@ -1,8 +1,11 @@
 from flask import request, jsonify
+from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
 from marshmallow import Schema, fields, ValidationError
 import re
 
+from api import invalidate_low_stock_alerts_cache
+
 # Input validation schema
 class ProductCreateSchema(Schema):
     name = fields.Str(required=True, validate=fields.Length(min=1, max=255))
@@ -12,9 +15,41 @@ class ProductCreateSchema(Schema):
     initial_quantity = fields.Int(required=True, validate=fields.Range(min=0))
     company_id = fields.Int(required=True)  # Added for proper authorization
 
+_SKU_RE = re.compile(r'[A-Za-z0-9-]+')
+
+# Warehouse ownership and SKU uniqueness checked in one round-trip
+_PRODUCT_PRECHECK_STMT = text("""
+    SELECT
+        EXISTS(
+            SELECT 1 FROM warehouses WHERE id = :warehouse_id AND company_id = :company_id
+        ) AS warehouse_ok,
+        EXISTS(SELECT 1 FROM products WHERE sku = :sku) AS sku_exists
+""")
+
+# Product, inventory and history rows are written in one round-trip
+_CREATE_PRODUCT_STMT = text("""
+    WITH new_product AS (
+        INSERT INTO products (name, sku, price, company_id)
+        VALUES (:name, :sku, :price, :company_id)
+        RETURNING id
+    ),
+    new_inventory AS (
+        INSERT INTO inventory (product_id, warehouse_id, quantity)
+        SELECT id, :warehouse_id, :quantity FROM new_product
+        RETURNING product_id
+    )
+    INSERT INTO inventory_history (
+        product_id, warehouse_id, change_type,
+        quantity_change, quantity_before, quantity_after, created_by
+    )
+    SELECT product_id, :warehouse_id, 'INITIAL_STOCK', :quantity, 0, :quantity, :created_by
+    FROM new_inventory
+    RETURNING product_id
+""")
+
 def validate_sku_format(sku):
     """Validate SKU follows expected format (alphanumeric + hyphens)"""
-    if not re.match(r'^[A-Za-z0-9\-]+$', sku):
+    if not _SKU_RE.fullmatch(sku):
         raise ValidationError("SKU must contain only letters, numbers, and hyphens")
 
 @app.route('/api/products', methods=['POST'])
@@ -30,62 +65,48 @@ def create_product():
         if not current_user.is_authenticated:
             return jsonify({"error": "Authentication required"}), 401
         
-        # Verify warehouse belongs to user's company
-        warehouse = Warehouse.query.filter_by(
-            id=data['warehouse_id'], 
-            company_id=data['company_id']
-        ).first()
+        # Verify warehouse belongs to user's company and check SKU uniqueness
+        checks = db.session.execute(_PRODUCT_PRECHECK_STMT, {
+            'warehouse_id': data['warehouse_id'],
+            'company_id': data['company_id'],
+            'sku': data['sku']
+        }).one()
         
-        if not warehouse:
+        if not checks.warehouse_ok:
             return jsonify({"error": "Invalid warehouse ID"}), 400
         
-        # Check SKU uniqueness
-        existing_product = Product.query.filter_by(sku=data['sku']).first()
-        if existing_product:
+        if checks.sku_exists:
             return jsonify({"error": "SKU already exists"}), 409
         
-        # Begin transaction
-        db.session.begin()
-        
+        # The session autobegins a transaction; commit/rollback below end it
         try:
-            # Create product (removed warehouse_id as products exist across warehouses)
-            product = Product(
-                name=data['name'],
-                sku=data['sku'],
-                price=data['price'],
-                company_id=data['company_id']
-            )
-            db.session.add(product)
-            db.session.flush()  # Get product.id without committing
-            
-            # Create initial inventory record
-            inventory = Inventory(
-                product_id=product.id,
-                warehouse_id=data['warehouse_id'],
-                quantity=data['initial_quantity']
-            )
-            db.session.add(inventory)
-            
-            # Create inventory history record
-            inventory_history = InventoryHistory(
-                product_id=product.id,
-                warehouse_id=data['warehouse_id'],
-                change_type='INITIAL_STOCK',
-                quantity_change=data['initial_quantity'],
-                new_quantity=data['initial_quantity'],
-                created_by=current_user.id
-            )
-            db.session.add(inventory_history)
+            # Create product (removed warehouse_id as products exist across warehouses),
+            # its initial inventory record and the inventory history record
+            product_id = db.session.execute(_CREATE_PRODUCT_STMT, {
+                'name': data['name'],
+                'sku': data['sku'],
+                'price': data['price'],
+                'company_id': data['company_id'],
+                'warehouse_id': data['warehouse_id'],
+                'quantity': data['initial_quantity'],
+                'created_by': current_user.id
+            }).scalar_one()
             
             # Commit transaction
             db.session.commit()
+            invalidate_low_stock_alerts_cache(data['company_id'])
             
             return jsonify({
                 "message": "Product created successfully",
-                "product_id": product.id,
-                "sku": product.sku
+                "product_id": product_id,
+                "sku": data['sku']
             }), 201
             
+        except IntegrityError:
+            # Let the outer handler map constraint violations (e.g. a concurrent
+            # duplicate SKU) to 409/400 instead of a generic 500
+            raise
+            
         except Exception as e:
             db.session.rollback()
             app.logger.error(f"Error creating product: {str(e)}")
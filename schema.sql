@@ -75,6 +75,8 @@ CREATE TABLE products (
     dimensions VARCHAR(100), -- e.g., "10x20x5 cm"
     is_bundle BOOLEAN DEFAULT false,
     is_active BOOLEAN DEFAULT true,
+    -- Denormalized from product_categories.low_stock_threshold (kept in sync by triggers)
+    low_stock_threshold INTEGER NOT NULL DEFAULT 10,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
@@ -142,6 +144,7 @@ CREATE TABLE sales (
     total_amount DECIMAL(10,2) NOT NULL,
     status VARCHAR(50) DEFAULT 'pending', -- 'pending', 'completed', 'cancelled'
     sale_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sale_day DATE GENERATED ALWAYS AS (sale_date::date) STORED, -- for per-day aggregation
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -165,12 +168,19 @@ CREATE INDEX idx_inventory_history_product_id ON inventory_history(product_id);
 CREATE INDEX idx_inventory_history_created_at ON inventory_history(created_at);
 CREATE INDEX idx_supplier_products_supplier_id ON supplier_products(supplier_id);
 CREATE INDEX idx_supplier_products_product_id ON supplier_products(product_id);
+-- At most one primary supplier per product (the alerts supplier lookup relies on it)
+CREATE UNIQUE INDEX idx_supplier_products_primary ON supplier_products(product_id)
+    WHERE is_primary_supplier = true;
 CREATE INDEX idx_sales_company_id_date ON sales(company_id, sale_date);
 CREATE INDEX idx_sale_items_product_id ON sale_items(product_id);
 CREATE INDEX idx_sale_items_warehouse_id ON sale_items(warehouse_id);
 CREATE INDEX idx_warehouses_company_id ON warehouses(company_id);
 CREATE INDEX idx_users_company_id ON users(company_id);
 
+-- Partial index for the completed-sales scan in the low stock alerts query
+CREATE INDEX idx_sales_completed_company_date ON sales(company_id, sale_date) INCLUDE (id, sale_day)
+    WHERE status = 'completed';
+
 -- Triggers for updated_at timestamps
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
@@ -194,3 +204,69 @@ CREATE TRIGGER update_products_updated_at BEFORE UPDATE ON products
 
 CREATE TRIGGER update_inventory_updated_at BEFORE UPDATE ON inventory
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+-- Triggers keeping products.low_stock_threshold in sync with its category
+CREATE OR REPLACE FUNCTION set_product_low_stock_threshold()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.low_stock_threshold = COALESCE(
+        (SELECT low_stock_threshold FROM product_categories WHERE id = NEW.category_id),
+        10
+    );
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+CREATE OR REPLACE FUNCTION propagate_category_low_stock_threshold()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE products
+    SET low_stock_threshold = COALESCE(NEW.low_stock_threshold, 10)
+    WHERE category_id = NEW.id;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER set_products_low_stock_threshold BEFORE INSERT OR UPDATE OF category_id ON products
+    FOR EACH ROW EXECUTE FUNCTION set_product_low_stock_threshold();
+
+CREATE TRIGGER propagate_product_categories_low_stock_threshold
+    AFTER UPDATE OF low_stock_threshold ON product_categories
+    FOR EACH ROW EXECUTE FUNCTION propagate_category_low_stock_threshold();
+
+-- Per-company sales velocity over the default 90-day window, used by the
+-- low stock alerts endpoint. Only this expensive sales aggregate is
+-- precomputed; inventory, thresholds and warehouses are joined live at
+-- request time, so stock and threshold changes show up immediately.
+--
+-- REQUIRED: schedule a refresh. Without one, the view stays as it was when
+-- this file ran (empty on a fresh install), and default-window alerts never
+-- include newer sales. Run every 5 minutes, e.g. from cron:
+--     */5 * * * * flask refresh-sales-velocity
+-- (see refresh_sales_velocity in api.py; it uses REFRESH ... CONCURRENTLY,
+-- which needs the unique index below)
+CREATE MATERIALIZED VIEW mv_recent_sales_velocity AS
+WITH daily_sales AS (
+    SELECT 
+        s.company_id,
+        si.product_id,
+        si.warehouse_id,
+        s.sale_day,
+        SUM(si.quantity) as quantity
+    FROM sale_items si
+    JOIN sales s ON si.sale_id = s.id
+    WHERE s.sale_date >= (now() AT TIME ZONE 'UTC') - INTERVAL '90 days'
+        AND s.status = 'completed'
+    GROUP BY s.company_id, si.product_id, si.warehouse_id, s.sale_day
+)
+SELECT 
+    company_id,
+    product_id,
+    warehouse_id,
+    SUM(quantity) as total_sold,
+    COUNT(*) as sales_days
+FROM daily_sales
+GROUP BY company_id, product_id, warehouse_id;
+
+CREATE UNIQUE INDEX idx_mv_recent_sales_velocity_pk
+    ON mv_recent_sales_velocity(company_id, product_id, warehouse_id);